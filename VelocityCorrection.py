@@ -4,38 +4,185 @@
 from __future__ import print_function, division, absolute_import
 
 
+import array
+import bisect
+import csv
+import itertools
+import logging
 import math
+import os
+import sys
+import tempfile
+
+
+log = logging.getLogger(__name__)
+
+
+# String types accepted as a single meteoroid or system type (Python 2 also has unicode strings)
+try:
+    _STRING_TYPES = (str, unicode)
+
+except NameError:
+    _STRING_TYPES = (str, )
+
+# Largest simulated zenith angle (degrees), larger angles are limited to it
+_MAX_ZANGLE_DEG = 75.0
+
+# System and meteoroid type IDs used in the fit table
+_SYSTEM_IDS = {'allsky': 0, 'moderate': 1, 'intensified': 2}
+_METEOROID_IDS = {'cometary': 0, 'asteroidal': 1, 'iron-rich': 2}
+
+# Fit tables split by (system ID, meteoroid ID), keyed by file name, so each CSV is read only once per 
+#   session
+_FIT_BUCKETS_CACHE = {}
 
 
 
 def loadFitCSV(file_name, delimiter=';'):
-    """ Loads velocity difference fit data. """
+    """ Loads velocity difference fit data as a list of rows, each stored as an array of doubles. """
 
 
     with open(file_name) as f:
 
         data = []
 
-        # Read velocity, zenith angle and fit parameters
-        for line in f:
+        # Skip the header, which is only at the beginning of the file
+        lines = itertools.dropwhile(lambda line: line.startswith('#'), f)
 
-            # Remove newline characters
-            line = line.replace('\n', '').replace('\r', '')
-
-            # Skip the header
-            if line[0] == '#':
-                continue
+        # Read velocity, zenith angle and fit parameters (the csv reader also handles the line endings)
+        for line in csv.reader(lines, delimiter=delimiter):
 
             # Add data to list
-            line = list(map(float, line.split(delimiter)))
-
-            data.append(line)
+            data.append(array.array('d', map(float, line)))
 
 
         return data
 
 
 
+def saveFitBinary(fit_data, file_name):
+    """ Saves the fit data loaded by loadFitCSV to a binary file, which is faster to load than the CSV. The 
+        file contains little-endian doubles, the first two being the number of columns and rows of the table.
+    """
+
+    data = array.array('d', [len(fit_data[0]), len(fit_data)])
+    for line in fit_data:
+        data.extend(line)
+
+    if sys.byteorder == 'big':
+        data.byteswap()
+
+    # Write to a temporary file first and move it into place, so a reader never sees a partially written file
+    fd, temp_name = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(file_name)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            data.tofile(f)
+
+        # mkstemp creates the file readable only by the owner, so give it the usual permissions set by umask
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_name, 0o666 & ~umask)
+
+        # os.replace is not available on Python 2, where os.rename also overwrites the file on POSIX
+        getattr(os, 'replace', os.rename)(temp_name, file_name)
+
+    except Exception:
+        os.remove(temp_name)
+        raise
+
+
+
+def loadFitBinary(file_name):
+    """ Loads velocity difference fit data saved by saveFitBinary. Raises ValueError if the file is not a 
+        complete table.
+    """
+
+    data = array.array('d')
+
+    file_size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as f:
+        data.fromfile(f, file_size//data.itemsize)
+
+    if sys.byteorder == 'big':
+        data.byteswap()
+
+    # Check that the file contains the table size followed by all rows of the table
+    if ((file_size%data.itemsize != 0) or (len(data) < 2) or not (data[0] >= 1) or (data[0]%1 != 0)
+        or (len(data) != 2 + data[0]*data[1])):
+
+        raise ValueError("The file " + file_name + " is not a valid binary fit table!")
+
+    n_columns = int(data[0])
+
+    return [data[i:i + n_columns] for i in range(2, len(data), n_columns)]
+
+
+
+def loadFitData(file_name):
+    """ Loads the velocity difference fit data from the given CSV file, or from its packed binary version if 
+        it is up to date. Unlike in the CSV file, velocities in the returned data are in km/s.
+    """
+
+    # Use the binary version of the table if it was generated from the current CSV file
+    bin_name = os.path.splitext(file_name)[0] + '.bin'
+    fit_data = None
+    if os.path.isfile(bin_name) and (os.path.getmtime(bin_name) >= os.path.getmtime(file_name)):
+
+        try:
+            fit_data = loadFitBinary(bin_name)
+
+        except (IOError, OSError, ValueError) as e:
+            log.warning('Could not load %s (%s), loading %s instead.', bin_name, e, file_name)
+
+    if fit_data is None:
+        fit_data = loadFitCSV(file_name)
+
+    # Convert the velocities from m/s to km/s
+    for line in fit_data:
+        line[2] /= 1000
+
+    return fit_data
+
+
+
+def getFitBuckets(file_name):
+    """ Returns the fit data from the given CSV file split into a dictionary by (system ID, meteoroid ID). 
+        The file is loaded and split only on the first call, and only the split data is kept.
+
+        Every bucket is stored by columns as a (velocities, velocity_indices, magnitudes, fit_params) tuple, 
+        where velocities is a sorted list of unique velocities, velocity_indices holds the indices of the 
+        rows with the corresponding velocity, and magnitudes and fit_params are the peak magnitudes and 
+        arrays of fit parameters of the rows, kept in the same order as in the file.
+    """
+
+    if file_name not in _FIT_BUCKETS_CACHE:
+
+        buckets = {}
+        for line in loadFitData(file_name):
+            buckets.setdefault((int(line[0]), int(line[1])), []).append(line)
+
+        for key, fit_data in buckets.items():
+
+            # Index the rows by velocity
+            rows_by_velocity = {}
+            for i, line in enumerate(fit_data):
+                rows_by_velocity.setdefault(line[2], []).append(i)
+
+            velocities = sorted(rows_by_velocity)
+            velocity_indices = [rows_by_velocity[vel] for vel in velocities]
+
+            # Split the magnitudes and the fit parameters into separate columns
+            magnitudes = array.array('d', [line[3] for line in fit_data])
+            fit_params = [line[4:] for line in fit_data]
+
+            buckets[key] = (velocities, velocity_indices, magnitudes, fit_params)
+
+        _FIT_BUCKETS_CACHE[file_name] = buckets
+
+    return _FIT_BUCKETS_CACHE[file_name]
+
+
+
 def zangleModel(zangle, a, b, c, d, e, f, g):
     """ Given the zenith angle and fit parameters, return the veloicty difference for the given value of
         initial velocity.
@@ -48,16 +195,111 @@ def zangleModel(zangle, a, b, c, d, e, f, g):
         [float] Velocity difference in m/s
     """
 
-    return a + b*zangle + c*zangle**2 + d*zangle**3 + e*zangle**4 + f*zangle**5 + g*zangle**6
+    # Evaluate the polynomial using Horner's scheme
+    return ((((((g*zangle + f)*zangle + e)*zangle + d)*zangle + c)*zangle + b)*zangle + a)
 
 
 
+def makeZangleModel(a, b, c, d, e, f, g):
+    """ Returns zangleModel with the given fit parameters fixed, for evaluating the same fit for many zenith 
+        angles.
+    
+    Arguments:
+        a, b, c, d, e, f, g: [float] Fit parameters.
+
+    Return:
+        [function] Takes the zenith angle (radians) and returns the velocity difference in m/s.
+    """
+
+    def model(zangle):
+        return zangleModel(zangle, a, b, c, d, e, f, g)
+
+    return model
+
+
+
+
+def getSystemFitData(meteoroid_type, system_type):
+    """ Returns the fits which correspond to the given meteoroid type and observation system. See 
+        velocityCorrection for the list of supported types.
+    """
+
+
+    # Define CSV file name with fits
+    preatm_csv_name = 'preatmosphere_fits.csv'
+    
+
+    # Choose the appropriate system id
+    try:
+        system_id = _SYSTEM_IDS[system_type]
+
+    except KeyError:
+        raise ValueError("system_type = " + system_type + " not found! Try using 'intensified', 'moderate' or 'allsky'.")
+
+
+    # Choose the appropriate meteoroid id
+    try:
+        meteoroid_id = _METEOROID_IDS[meteoroid_type]
+
+    except KeyError:
+        raise ValueError("meteoroid_type = " + meteoroid_type + " not found! Try using 'comeraty', 'asteroidal' or 'iron-rich'.")
+
+    
+    # Take only those fits which correspond to the given system and meteoroid type (the CSV file is loaded 
+    #   and split only on the first call)
+    return getFitBuckets(preatm_csv_name)[(system_id, meteoroid_id)]
+
+
+
+def matchFitParameters(fit_table, v_init, peak_mag):
+    """ Finds the table entry with the closest velocity and, among those, the closest peak magnitude.
+
+    Arguments:
+        fit_table: [tuple] Fits for one system and meteoroid type, as returned by getSystemFitData.
+        v_init: [float] Initial velocity (km/s).
+        peak_mag: [float] Peak magnitude of the meteor.
+
+    Return:
+        [array] Fit parameters of the matched table entry.
+    """
+
+    velocities, velocity_indices, magnitudes, fit_params = fit_table
+
+    # Find the closest velocities in the table, which are the ones around the given velocity in the sorted 
+    #   list (both are taken if they are equally close)
+    i = bisect.bisect_left(velocities, v_init)
+    candidates = [j for j in (i - 1, i) if 0 <= j < len(velocities)]
+    vel_diffs = [abs(velocities[j] - v_init) for j in candidates]
+    candidates = [j for j, vel_diff in zip(candidates, vel_diffs) if vel_diff == min(vel_diffs)]
+
+    # Find the best matching magnitude for the closest velocity, taking the first row in the file in case 
+    #   of a tie
+    best_ind = best_vel = None
+    best_mag_diff = float('inf')
+    for j in candidates:
+        for k in velocity_indices[j]:
+
+            mag_diff = abs(magnitudes[k] - peak_mag)
+            if ((best_ind is None) or (mag_diff < best_mag_diff)
+                or ((mag_diff == best_mag_diff) and (k < best_ind))):
+
+                best_ind = k
+                best_vel = velocities[j]
+                best_mag_diff = mag_diff
+
+    log.debug('Matched table entry: velocity = %s km/s, peak magnitude = %s, fit parameters = %s', best_vel, 
+        magnitudes[best_ind], fit_params[best_ind])
+
+    # Take the appropriate fit parameters
+    return fit_params[best_ind]
+
+
 
 def velocityCorrection(v_init, peak_mag, zangle, meteoroid_type, system_type):
     """ Returns a difference in velocity for the given meteoroid type, observation system, initial 
         velocity and zenith angle, as given by Vida et al. 2017. For the areas of the velocity/zenith angle 
         phase space where no simulations were above the detection limit, the difference is taken for the
-        closest available velocity.
+        closest available velocity. To correct many meteors at once, use velocityCorrectionBatch.
 
 
     Arguments:
@@ -81,76 +323,115 @@ def velocityCorrection(v_init, peak_mag, zangle, meteoroid_type, system_type):
 
 
     # Limit the zenith angle to 75 degrees
-    if zangle > 75:
-        zangle = 75.0
+    zangle = min(zangle, _MAX_ZANGLE_DEG)
 
+    zangle_rad = math.radians(zangle)
 
-    # Define CSV file name with fits
-    preatm_csv_name = 'preatmosphere_fits.csv'
-    
 
-    # Choose the appropriate system id
-    if system_type == 'intensified':
-        system_id = 2
+    # Take only those fits which correspond to the given system and meteoroid type
+    fit_table = getSystemFitData(meteoroid_type, system_type)
 
-    elif system_type == 'moderate':
-        system_id = 1
+    # Take the fit parameters of the best matching table entry
+    fit_params = matchFitParameters(fit_table, v_init, peak_mag)
 
-    elif system_type == 'allsky':
-        system_id = 0
+    # Computethe velocity difference in km/s
+    return zangleModel(zangle_rad, *fit_params)/1000
 
-    else:
-        raise ValueError("system_type = " + system_type + " not found! Try using 'intensified', 'moderate' or 'allsky'.")
 
 
-    # Choose the appropriate meteoroid id
-    if meteoroid_type == 'cometary':
-        meteoroid_id = 0
+def velocityCorrectionModel(v_init, peak_mag, meteoroid_type, system_type):
+    """ Returns the velocity correction as a function of the zenith angle for a meteor of the given initial 
+        velocity, peak magnitude, meteoroid type and observation system. The table lookup is done only 
+        once, which makes this suitable for sweeps over many zenith angles. See velocityCorrection for 
+        details.
 
-    elif meteoroid_type == 'asteroidal':
-        meteoroid_id = 1
 
-    elif meteoroid_type == 'iron-rich':
-        meteoroid_id = 2
+    Arguments:
+        v_init: [float] Initial velocity (km/s).
+        peak_mag: [float] Peak magnitude of the meteor.
+        meteoroid_type: [str] Type of meteoroid, see velocityCorrection.
+        system_type: [str] Type of observational system, see velocityCorrection.
 
-    else:
-        raise ValueError("meteoroid_type = " + meteoroid_type + " not found! Try using 'comeraty', 'asteroidal' or 'iron-rich'.")
 
-    
-    # Load the appropriate CSV file
-    fit_data = loadFitCSV(preatm_csv_name)
+    Return:
+        [function] Takes the zenith angle (degrees, limited to 75 deg) and returns the velocity difference 
+            in km/s.
+    """
+
 
     # Take only those fits which correspond to the given system and meteoroid type
-    fit_data = [line for line in fit_data if line[0] == system_id]
-    fit_data = [line for line in fit_data if line[1] == meteoroid_id]
+    fit_table = getSystemFitData(meteoroid_type, system_type)
 
-    # Compute absolute differences between the given velocity and velocities in the table
-    vel_diffs = [abs(line[2]/1000 - v_init) for line in fit_data]
+    # Specialize the model for the fit parameters of the best matching table entry
+    model = makeZangleModel(*matchFitParameters(fit_table, v_init, peak_mag))
 
-    # Find indices with best matching velocities
-    vel_indices = [i for i, x in enumerate(vel_diffs) if x == min(vel_diffs)]
-    
-    # Compute absolute differences between the given magnitude and magnitudes of the given velocity
-    mag_diffs = [abs(fit_data[vel_ind][3] - peak_mag) for vel_ind in vel_indices]
 
-    # Find the best matching magnitude for the given velocity
-    mag_ind = mag_diffs.index(min(mag_diffs))
+    def correction(zangle):
 
-    print('Matched table entry:')
-    print(fit_data[vel_indices[mag_ind]])
-    print()
+        # Limit the zenith angle to 75 degrees
+        zangle = min(zangle, _MAX_ZANGLE_DEG)
 
-    # Take the appropriate fit parameters
-    fit_params = fit_data[vel_indices[mag_ind]][4:]
+        # Compute the velocity difference in km/s
+        return model(math.radians(zangle))/1000
 
-    # Computethe velocity difference in km/s
-    return zangleModel(math.radians(zangle), *fit_params)/1000
+
+    return correction
+
+
+
+def velocityCorrectionBatch(v_inits, peak_mags, zangles, meteoroid_types, system_types):
+    """ Returns velocity differences for a batch of meteors, one for every meteor in the same order as the 
+        inputs. See velocityCorrection for details.
+
+
+    Arguments:
+        v_inits: [list] Initial velocities (km/s).
+        peak_mags: [list] Peak magnitudes of the meteors.
+        zangles: [list] Zenith angles (degrees), limited to 75 deg.
+        meteoroid_types: [list or str] Types of meteoroids, see velocityCorrection. If a single string is 
+            given, it is used for all meteors.
+        system_types: [list or str] Types of observational systems, see velocityCorrection. If a single 
+            string is given, it is used for all meteors.
+
+        All given lists must be of the same length.
+
+
+    Return:
+        [list] Velocity differences in km/s.
+    """
+
+
+    # Use the same type for all meteors if only one is given
+    if isinstance(meteoroid_types, _STRING_TYPES):
+        meteoroid_types = [meteoroid_types]*len(v_inits)
+
+    if isinstance(system_types, _STRING_TYPES):
+        system_types = [system_types]*len(v_inits)
+
+
+    # Make sure that every meteor has all inputs, as zip would silently drop the extra ones
+    input_lengths = [len(inputs) for inputs in (v_inits, peak_mags, zangles, meteoroid_types, system_types)]
+    if len(set(input_lengths)) > 1:
+        raise ValueError("Inputs have different lengths " + str(input_lengths) + "! All of v_inits, "
+            + "peak_mags, zangles, meteoroid_types and system_types must have one entry for every meteor.")
+
+
+    delta_v_list = []
+    for v_init, peak_mag, zangle, meteoroid_type, system_type in zip(v_inits, peak_mags, zangles, 
+        meteoroid_types, system_types):
+
+        delta_v_list.append(velocityCorrection(v_init, peak_mag, zangle, meteoroid_type, system_type))
+
+
+    return delta_v_list
 
 
 
 
 if __name__ == "__main__":
 
+    # Show the matched table entry
+    logging.basicConfig(level=logging.DEBUG, format='%(message)s')
     
     # INITIAL VELOCITY (km/s)
     v_init = 20.0
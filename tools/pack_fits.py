@@ -0,0 +1,31 @@
+""" Packs the fit CSV into a binary file which VelocityCorrection.py loads faster than the CSV. Rerun it 
+    whenever the CSV changes, as a binary file older than the CSV is ignored.
+
+Usage:
+    python tools/pack_fits.py [preatmosphere_fits.csv]
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from VelocityCorrection import loadFitCSV, saveFitBinary
+
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        csv_name = sys.argv[1]
+
+    else:
+        csv_name = 'preatmosphere_fits.csv'
+
+    bin_name = os.path.splitext(csv_name)[0] + '.bin'
+
+    saveFitBinary(loadFitCSV(csv_name), bin_name)
+
+    print('Saved', bin_name)